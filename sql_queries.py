@@ -1,5 +1,9 @@
+# columns of the sql_graph_ethereum result that can be used to rank transactions
+RANK_BY_COLUMNS = ('amount_usd', 'amount', 'block_timestamp', 'decimals', 'symbol', 'tx_hash')
+
 def to_lowercase_tuple(strings):
-    lowercase_strings = [s.lower() for s in strings]
+    # sorted and unique so the same set of addresses always gives the same query text (lets flipside reuse cached results)
+    lowercase_strings = sorted(set(s.lower() for s in strings))
     if len(lowercase_strings) == 1:
         return "('" + lowercase_strings[0] + "')"
     else:
@@ -7,25 +11,19 @@ def to_lowercase_tuple(strings):
 
 def sql_graph_ethereum(addresses,limit,rank_by):
     
+    # rank_by and limit are spliced into the query text, so only accept known columns and integer limits
+    if rank_by not in RANK_BY_COLUMNS:
+        raise ValueError(f"rank_by must be one of {RANK_BY_COLUMNS}, got {rank_by!r}")
+    limit = int(limit)
+    
+    # addresses are stored lowercase in the warehouse, so lowercase our side once rather than lower() every row
+    addresses_sql = to_lowercase_tuple(addresses)
+    
     sql_query = f"""
     WITH 
-    tokens_from AS
-    ( 
-        SELECT  symbol,
-                decimals, 
-                amount, 
-                amount_usd, 
-                tx_hash, 
-                from_address, 
-                to_address, 
-                block_timestamp
-        FROM ethereum.core.ez_token_transfers
-        WHERE lower(from_address) IN {to_lowercase_tuple(addresses)}
-    ),
-  
-    tokens_to AS
+    tokens AS
     ( 
-        SELECT  symbol,
+        SELECT DISTINCT symbol,
                 decimals, 
                 amount, 
                 amount_usd, 
@@ -34,26 +32,13 @@ def sql_graph_ethereum(addresses,limit,rank_by):
                 to_address, 
                 block_timestamp
         FROM ethereum.core.ez_token_transfers
-        WHERE lower(to_address) IN {to_lowercase_tuple(addresses)}
+        WHERE from_address IN {addresses_sql}
+           OR to_address IN {addresses_sql}
     ),
  
-    eth_from AS
-    ( 
-        SELECT  'ETH' AS symbol,
-                18 AS decimals, 
-                amount, 
-                amount_usd, 
-                tx_hash, 
-                eth_from_address, 
-                eth_to_address, 
-                block_timestamp
-        FROM ethereum.core.ez_eth_transfers
-        WHERE lower(eth_from_address) IN {to_lowercase_tuple(addresses)}
-    ),
-  
-    eth_to AS
+    eth AS
     ( 
-        SELECT  'ETH' AS symbol,
+        SELECT DISTINCT 'ETH' AS symbol,
                 18 AS decimals, 
                 amount, 
                 amount_usd, 
@@ -62,26 +47,13 @@ def sql_graph_ethereum(addresses,limit,rank_by):
                 eth_to_address, 
                 block_timestamp
         FROM ethereum.core.ez_eth_transfers
-        WHERE lower(eth_to_address) IN {to_lowercase_tuple(addresses)}
-    ),
-
-    tokens AS
-    (
-      SELECT * FROM tokens_from
-      UNION ALL
-      SELECT * FROM tokens_to
-    ),
-  
-    eth AS
-    (
-      SELECT * FROM eth_from
-      UNION ALL
-      SELECT * FROM eth_to
-    )  
+        WHERE eth_from_address IN {addresses_sql}
+           OR eth_to_address IN {addresses_sql}
+    )
   
-    SELECT DISTINCT * FROM tokens
+    SELECT * FROM tokens
     UNION ALL
-    SELECT DISTINCT * FROM eth
+    SELECT * FROM eth
     ORDER BY {rank_by} DESC NULLS LAST
     LIMIT {limit}
     """
@@ -93,7 +65,7 @@ def sql_labels_ethereum(addresses):
     sql_query = f"""
     SELECT address, label, label_subtype, label_type
     FROM ethereum.core.dim_labels
-    WHERE lower(address) IN {to_lowercase_tuple(addresses)}
+    WHERE address IN {to_lowercase_tuple(addresses)}
     """
     return sql_query
     
@@ -102,7 +74,7 @@ def sql_contracts_ethereum(addresses):
     sql_query = f"""
     SELECT address, name, symbol as label
     FROM ethereum.core.dim_contracts
-    WHERE lower(address) IN {to_lowercase_tuple(addresses)}
+    WHERE address IN {to_lowercase_tuple(addresses)}
     """
     return sql_query
 
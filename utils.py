@@ -1,22 +1,75 @@
+import numpy as np
 import pandas as pd
 import networkx as nx
 import pyvis as pv
-import copy
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pyvis.network import Network
 from urllib.request import Request, urlopen
 from sql_queries import sql_labels_ethereum, sql_graph_ethereum, sql_contracts_ethereum
 
+# columns identifying a single transfer (one tx_hash can contain several transfers)
+TRANSFER_KEY = ['tx_hash','from_address','to_address','symbol','amount']
+
+class QueryResult:
+    """Lightweight stand-in for an sdk query result, exposing only the records"""
+    def __init__(self, records):
+        self.records = records
+
+
+def cached_query(sdk, sql, cache_dir=None):
+    
+    """
+    Runs sdk.query(sql), caching the records on disk so that re-running the same query returns instantly
+    
+    Args:
+        sdk: flipside api instance
+        sql: query string (sql_queries functions sort addresses, so the same address set gives the same key)
+        cache_dir: directory to store cached results in, or None (default) to always query the api
+    """
+    
+    if cache_dir is None:
+        return QueryResult(sdk.query(sql).records)
+    
+    path = os.path.join(cache_dir, hashlib.sha1(sql.encode()).hexdigest() + '.pkl')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return QueryResult(pickle.load(f))
+    
+    records = sdk.query(sql).records
+    # don't cache empty results, an address with no transfers/labels now may have some later
+    if records is None:
+        return QueryResult(records)
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file and move it into place, so an interrupted run never leaves a truncated cache entry
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(records, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return QueryResult(records)
+
+
 def grow_df(seed_addresses,
             nogrow_addresses,
             sdk,
-            address_label_dict={},
-            contracts=[],
-            spam_symbols=[], 
-            df=pd.DataFrame(),
+            address_label_dict=None,
+            contracts=None,
+            spam_symbols=None,
+            df=None,
             drop_spam=True,
             limit_connections='500',
             rank_by='amount_usd',
-            stop_at_label=True):
+            stop_at_label=True,
+            cache_dir=None):
     
     """
     Grows a dataframe from a set of seed addresses and information about a previous dataframe
@@ -28,22 +81,37 @@ def grow_df(seed_addresses,
         nogrow_addresses: list of addresses that we won't query (i.e we aren't interested in finding other transactions related to these addresses)
         sdk: flipside api instance
         address_label_dict: dictionary with addresses as keys and labels as values for any previous state of the graph
-        contracts: list of addresses already confirmed to be contract addresses (don't want to continue to grow the graph from these as there are likely too many irrelevant connections)
+        contracts: set (or list) of addresses already confirmed to be contract addresses (don't want to continue to grow the graph from these as there are likely too many irrelevant connections)
         df: pandas.DataFrame() object from previous version of the graph
         drop_spam: Bool, if true removes transactions involving spam tokens (not having a token symbol in the api query)
         limit_connections: Limit on number of transaction results returned by address query
-        rank_by: With above limi_connections, determines which transactions make the cut
+        rank_by: With above limi_connections, determines which transactions make the cut (one of sql_queries.RANK_BY_COLUMNS)
         stop_at_label: Bool, if true adds labelled addressses to nogrow_addresses, e.g. so that once a "Binance" is found, we don't look for all connections to that label
+        cache_dir: optional directory to cache query results on disk (e.g. '.cache'), results never expire so clear it to pick up new transactions. None (default) always queries the api
     
     """
     
+    # addresses are lowercase in the api results, so lowercase the inputs once here
+    seed_addresses = [x.lower() for x in seed_addresses]
+    nogrow_addresses = [x.lower() for x in nogrow_addresses]
+    
+    # sets for fast membership tests when filtering address lists
+    nogrow_set = set(nogrow_addresses)
+    seed_set = set(seed_addresses)
+    
+    # fresh empty defaults on every call (a default {} / [] / DataFrame would be shared between calls)
+    address_label_dict = {} if address_label_dict is None else address_label_dict
+    contracts = set() if contracts is None else {x.lower() for x in contracts}
+    spam_symbols = [] if spam_symbols is None else spam_symbols
+    df = pd.DataFrame() if df is None else df
+    
     # remove any nogrow_addresses we don't want to grow the dataframe (df) from
-    seed_addresses = [x for x in seed_addresses if x not in nogrow_addresses]
+    seed_addresses = [x for x in seed_addresses if x not in nogrow_set]
         
     # run query for all seed address and build a dataframe of transactions
     print(f"Running address query")
-    result = sdk.query(sql_graph_ethereum(seed_addresses,limit_connections,rank_by))
-    if dict(result)["records"] == None:
+    result = cached_query(sdk, sql_graph_ethereum(seed_addresses,limit_connections,rank_by), cache_dir)
+    if result.records == None:
         print('Warning: No records found for address(es)')
         address_label_dict_new = address_label_dict
         contracts_new = contracts
@@ -66,51 +134,74 @@ def grow_df(seed_addresses,
         
         # Initiate new empty dict for indexing new labels
         address_label_dict_new = {}
+        # only look up addresses that aren't already resolved in the previous state of the graph
+        label_query_addresses = [x for x in new_addresses if x not in address_label_dict]
+        contract_query_addresses = [x for x in label_query_addresses if x not in contracts]
+        
+        # contract and label queries both only depend on new_addresses, so run them concurrently to overlap api latency
+        print(f"Running contract and label queries")
+        contracts_future = labels_future = None
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            if contract_query_addresses:
+                contracts_future = executor.submit(cached_query, sdk, sql_contracts_ethereum(contract_query_addresses), cache_dir)
+            if label_query_addresses:
+                labels_future = executor.submit(cached_query, sdk, sql_labels_ethereum(label_query_addresses), cache_dir)
+        
         # look for contracts (dont want to grow the graph from these because too many possible connections)
-        print(f"Running contract query")
-        result = sdk.query(sql_contracts_ethereum(new_addresses))
-        if dict(result)["records"] == None:
-            print('No contracts found')
+        result = contracts_future.result() if contracts_future else None
+        if result is None or result.records == None:
+            if contracts_future is None:
+                print('All addresses already resolved, skipping contract query')
+            else:
+                print('No contracts found')
             contracts_new = contracts
         else:
             # make new dataframe with results
-            contracts_new = pd.json_normalize(result.records)
+            contracts_df = pd.json_normalize(result.records)
             # use labels if any to update address_label_dict_new
-            address_label_dict_new.update({row['address']: row['label'] for index, row in contracts_new.iterrows() if row['label'] != None})    
-            # add new contracts to list of input contracts
-            contracts_new = list(set(contracts_new['address'])) # convert to list
-            contracts_new.extend(contracts) # append to input list of contracts
+            labelled = contracts_df[contracts_df['label'].notna()]
+            address_label_dict_new.update(zip(labelled['address'].values, labelled['label'].values))
+            # add new contracts to set of input contracts
+            contracts_new = contracts | set(contracts_df['address'])
 
-        # run query to get labels
-        print(f"Running label query")
-        result = sdk.query(sql_labels_ethereum(new_addresses))
-        if dict(result)["records"] == None:
-            print('No labels found')
+        # get labels
+        result = labels_future.result() if labels_future else None
+        if result is None or result.records == None:
+            if labels_future is None:
+                print('All addresses already resolved, skipping label query')
+            else:
+                print('No labels found')
         else:
             # make new dataframe with results
             labels_new = pd.json_normalize(result.records)
             # add new labels to dict
-            address_label_dict_new.update({row['address']: row['label'] for index, row in labels_new.iterrows()}) # overwrites contract labels if new label (labels from label query are generally better than from contract query)
+            labelled = labels_new[labels_new['label'].notna()]
+            address_label_dict_new.update(zip(labelled['address'].values, labelled['label'].values)) # overwrites contract labels if new label (labels from label query are generally better than from contract query)
         
         # shorten unlabelled addresses
-        address_label_dict_new.update({x: x[0:3] + x[-3:] for x in new_addresses if x not in list(address_label_dict_new.keys())}) 
+        unlabelled = set(new_addresses) - address_label_dict_new.keys()
+        address_label_dict_new.update({x: x[0:3] + x[-3:] for x in unlabelled})
         
         # update address_label_dict using previous map
         address_label_dict_new.update(address_label_dict)
     
+        # one row per transfer, keyed on TRANSFER_KEY columns rather than comparing every column
+        df_new = df_new.drop_duplicates(subset=TRANSFER_KEY, keep='last')
+        
+        # only keep transfers not already in the pre-existing df, rather than deduplicating the whole concatenated df
+        if not df.empty:
+            seen = pd.MultiIndex.from_frame(df[TRANSFER_KEY])
+            df_new = df_new[~pd.MultiIndex.from_frame(df_new[TRANSFER_KEY]).isin(seen)]
+        
         # append new df to pre-existing df
-        df_new = pd.concat([df,df_new])
-        # remove duplicate tx_hash again if any
-        df_new = df_new.drop_duplicates()
+        df_new = pd.concat([df,df_new], ignore_index=True)
     
     
     # create dict of labels, and all associated full-addresses (opposite of address_label_dict)
-    label_address_dict = {}
+    label_address_dict = defaultdict(list)
     for key, value in address_label_dict_new.items():
-        if value not in label_address_dict:
-            label_address_dict[value] = [key]
-        else:
-            label_address_dict[value].append(key)
+        label_address_dict[value].append(key)
+    label_address_dict = dict(label_address_dict)
 
 
     # generate new list of seed addresses that would grow the graph one step further if needed
@@ -121,12 +212,49 @@ def grow_df(seed_addresses,
     else:
         adds = [add for add, label in address_label_dict_new.items()]
     
-    seed_addresses = [add for add in adds if add not in seed_addresses]
-    seed_addresses = [add for add in seed_addresses if add not in nogrow_addresses]
+    seed_addresses = [add for add in adds if add not in seed_set and add not in nogrow_set]
     
 
     return seed_addresses, nogrow_addresses, address_label_dict_new, label_address_dict, contracts_new, df_new
 
+
+def edge_statistics(from_label, to_label, amount_usd):
+    
+    """
+    Computes the summary statistics of the edge (pair of labels) each transaction belongs to, counting transactions in both directions
+    
+    Args:
+        from_label: numpy array of the from label of each transaction
+        to_label: numpy array of the to label of each transaction
+        amount_usd: numpy array (float) of the usd amount of each transaction, nan amounts are counted as transactions but add no volume
+    
+    Returns:
+        usd_vol, usd_net_vol_out, n_transactions: numpy arrays with one entry per transaction
+    """
+    
+    # shared integer codes for from/to labels, so each directed edge has a single integer key
+    # (missing labels get their own code rather than -1, so all codes are >= 0 and keys can't collide)
+    codes, uniques = pd.factorize(np.concatenate([from_label, to_label]), use_na_sentinel=False)
+    codes = codes.astype(np.int64)
+    from_codes, to_codes = codes[:len(from_label)], codes[len(from_label):]
+    edge_keys, edge_index = np.unique(from_codes*len(uniques) + to_codes, return_inverse=True)
+    
+    # single pass reduction of volume and count for every directed edge
+    vol_out = np.bincount(edge_index, weights=np.nan_to_num(amount_usd), minlength=len(edge_keys))
+    n_out = np.bincount(edge_index, minlength=len(edge_keys))
+    
+    # find the reverse (to -> from) edge of each transaction, if there is one (trailing -1 sentinel never matches)
+    reverse_keys = to_codes*len(uniques) + from_codes
+    reverse_index = np.searchsorted(edge_keys, reverse_keys)
+    has_reverse = np.append(edge_keys, -1)[reverse_index] == reverse_keys
+    vol_in = np.where(has_reverse, np.append(vol_out, 0)[reverse_index], 0)
+    n_in = np.where(has_reverse, np.append(n_out, 0)[reverse_index], 0)
+    
+    vol_out = vol_out[edge_index]
+    n_out = n_out[edge_index]
+    
+    return vol_out + vol_in, vol_out - vol_in, n_out + n_in
+
     
 def draw_graph(df,address_label_dict,label_address_dict,contracts,name):
     
@@ -137,57 +265,68 @@ def draw_graph(df,address_label_dict,label_address_dict,contracts,name):
         df: pandas.DataFrame() of transactions
         addresss_label_dict: dictionary of each address and its associated label
         label_addresss_dict: dictionary of each label and all associated addresses
-        contracts: list of addresses that are known to be contracts
+        contracts: set of addresses that are known to be contracts
         name: string of html graph filename, e.g "test" -> "test.html"
     """
     
+    # set of contracts for fast membership tests when decorating nodes
+    contracts_set = set(contracts)
+    
     # color palette
     color_palette = ['#2d728f', '#F5EE9E', '#AB3428', '#F49E4C', '#3b8ea5']
     
     # Enrich df with from/to labels
-    df_new = copy.copy(df) # just to avoid inplace operations altering the df outside of the function
-    df_new = df_new.reset_index(drop=True) # some indexes will have been repeated, which would cause trouble
-    for index, row in df_new.iterrows():
-        from_add = row["from_address"]
-        to_add = row["to_address"]
-        # add from/to labels (so we can group transactions by node labels)
-        from_label = address_label_dict[from_add]
-        to_label = address_label_dict[to_add]
-        df_new.loc[index,"from_label"] = from_label
-        df_new.loc[index,"to_label"] = to_label
-        # All rows now labelled with from_label/to_label
+    # reset_index returns a new frame (the only copy of df made here), so columns can be added in place without altering df outside of the function
+    df_new = df.reset_index(drop=True) # some indexes will have been repeated, which would cause trouble
+    df_new["from_label"] = df_new["from_address"].map(address_label_dict)
+    df_new["to_label"] = df_new["to_address"].map(address_label_dict)
+    # every address must have a label (grow_df labels all addresses it finds)
+    missing = set(df_new.loc[df_new["from_label"].isna(), "from_address"]) | set(df_new.loc[df_new["to_label"].isna(), "to_address"])
+    if missing:
+        raise KeyError(f"No label in address_label_dict for address(es): {sorted(missing)}")
+    # All rows now labelled with from_label/to_label
     
     # now enrich with summary statistics for each edge, vols, net vols, n_transactions,
-    for index, row in df_new.iterrows():
-        from_label = row["from_label"]
-        to_label = row["to_label"]
-        df_out = df_new.query(f"from_label=='{from_label}' and to_label=='{to_label}'")["amount_usd"]
-        df_in = df_new.query(f"from_label=='{to_label}' and to_label=='{from_label}'")["amount_usd"]
-        n_transactions = int(len(df_out) + len(df_in))
-        vol_out = df_out.sum(skipna=True)
-        vol_in = df_in.sum(skipna=True)
-        vol = vol_in + vol_out
-        net_vol = vol_out - vol_in
-        
-        # add volume and label info to df_new
-        df_new.loc[index,"usd_net_vol_out"] = net_vol
-        df_new.loc[index,"usd_vol"] = vol
-        df_new.loc[index,"n_transactions"] = n_transactions
+    usd_vol, usd_net_vol_out, n_transactions = edge_statistics(df_new["from_label"].to_numpy(),
+                                                               df_new["to_label"].to_numpy(),
+                                                               df_new["amount_usd"].to_numpy(dtype=float))
+    
+    # add volume and label info to df_new
+    df_new["usd_net_vol_out"] = usd_net_vol_out
+    df_new["usd_vol"] = usd_vol
+    df_new["n_transactions"] = n_transactions
         
     
     # sort (this helps keep the "middle" arrow correct when drawing graph, such that it's parallel to net-flow between nodes)
     #df_new = df_new.sort_values("usd_net_vol_out")
     
+    # visual width/weight of edges scaled by volume, computed for all edges at once
+    vol_usd_max = df_new['usd_vol'].max()
+    df_new.eval("""
+                edge_width = 1 + 20*usd_vol/@vol_usd_max
+                edge_weight = 1 + 5*usd_vol/@vol_usd_max
+                """, inplace=True)
+    
+    # edges only connecting unlabelled addresses are red, any edge touching a labelled node is yellow
+    unlabelled_edge = df_new['from_label'].str.startswith('0x') & df_new['to_label'].str.startswith('0x')
+    df_new["edge_color"] = np.where(unlabelled_edge, color_palette[2], color_palette[3])
+    # hover text, with the label pair ordered in the direction of net flow
+    out_bigger = df_new['usd_net_vol_out'] >= 0
+    flow_src = np.where(out_bigger, df_new['from_label'], df_new['to_label'])
+    flow_dst = np.where(out_bigger, df_new['to_label'], df_new['from_label'])
+    df_new["edge_title"] = [f"Volume = ${vol:,.2f}\nNet Volume = ${abs(net_vol):,.2f} ({src}-->{dst})\nn_transactions = {n:.0f}"
+                            for vol, net_vol, n, src, dst in zip(df_new['usd_vol'], df_new['usd_net_vol_out'],
+                                                                 df_new['n_transactions'], flow_src, flow_dst)]
+    
     # make graph from transaction df_new (edgelist) 
-    G = nx.from_pandas_edgelist(df_new,
-                            source='from_label',
-                            target = 'to_label',
-                            edge_attr = ('symbol','amount','amount_usd',
-                                         'tx_hash','block_timestamp','from_address',
-                                         'to_address','from_label','to_label',
-                                         'n_transactions','usd_vol','usd_net_vol_out'),
-                            create_using=nx.MultiDiGraph,
-                           )
+    edge_attr = ('symbol','amount','amount_usd',
+                 'tx_hash','block_timestamp','from_address',
+                 'to_address','from_label','to_label',
+                 'n_transactions','usd_vol','usd_net_vol_out',
+                 'edge_width','edge_weight','edge_color','edge_title')
+    edges = df_new[['from_label','to_label',*edge_attr]].itertuples(index=False, name=None)
+    G = nx.MultiDiGraph()
+    G.add_edges_from((row[0], row[1], dict(zip(edge_attr, row[2:]))) for row in edges)
     
     
     # use this label_address_dict to add these associated addresses to each node as an attribute
@@ -205,13 +344,12 @@ def draw_graph(df,address_label_dict,label_address_dict,contracts,name):
     net.repulsion()
     net.from_nx(G)
 
-    vol_usd_max = df_new['usd_vol'].max() # for scaling visual width of edges 
                     
     for node in net.nodes:
         
         node["title"] = "Addresses:\n" + "\n".join(set(node["full_addresses"]))
         if not node["label"].startswith('0x'):
-            if any(x in node["full_addresses"] for x in contracts): # contracts shaped as squares
+            if not contracts_set.isdisjoint(node["full_addresses"]): # contracts shaped as squares
                 node["size"] = 15
                 node["color"] = color_palette[3]
                 node["shape"] = 'square'
@@ -220,29 +358,15 @@ def draw_graph(df,address_label_dict,label_address_dict,contracts,name):
                 node["color"] = color_palette[3]
         else:
             node["color"] = color_palette[2]
-            if any(x in node["full_addresses"] for x in contracts):
+            if not contracts_set.isdisjoint(node["full_addresses"]):
                 node["shape"] = 'square'
                     
     for edge in net.edges:
-
-        # find volume of all edges with these endpoints
-        
-        out_bigger = edge["usd_net_vol_out"]>=0
-        usd_vol = edge['usd_vol']
-        usd_net_vol = edge['usd_net_vol_out']
-        # edge decoration
-        edge["width"] = 1 + 20*usd_vol/vol_usd_max
-        edge["weight"] = 1 + 5*usd_vol/vol_usd_max
-        if edge["from"].startswith('0x') and edge["to"].startswith("0x"):
-            edge["color"] = color_palette[2]
-        else:
-            edge["color"] = color_palette[3]
-        
-        
-        if out_bigger:
-            edge["title"] = f"Volume = ${usd_vol:,.2f}\nNet Volume = ${abs(usd_net_vol):,.2f} ({edge['from']}-->{edge['to']})\nn_transactions = {edge['n_transactions']:.0f}"
-        else:
-            edge["title"] = f"Volume = ${usd_vol:,.2f}\nNet Volume = ${abs(usd_net_vol):,.2f} ({edge['to']}-->{edge['from']})\nn_transactions = {edge['n_transactions']:.0f}"    
+        # edge decoration (precomputed on df_new), popped so each value is only serialized once
+        edge["width"] = edge.pop("edge_width")
+        edge["weight"] = edge.pop("edge_weight")
+        edge["color"] = edge.pop("edge_color")
+        edge["title"] = edge.pop("edge_title")
             
     net.show_buttons(('physics','edges'))
     net.save_graph(name +'.html')    